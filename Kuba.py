@@ -2,17 +2,172 @@
 # Date: 6/4/2021
 # Description: A program that implements classes to ply the board game Kuba
 
+# (row, column) offsets of each direction, and the index of each direction's
+# offsets by name
+_DIR_OFFSETS = ((-1, 0), (0, 1), (0, -1), (1, 0))
+_DIR_INDEX = {'F': 0, 'R': 1, 'L': 2, 'B': 3}
+
+
+def _build_neighbor_tables(size, offsets):
+  """Build per-cell on-board neighbor masks and the bitmask of edge cells."""
+  neighbors = []
+  edge = 0
+  for i in range(size * size):
+    r, c = divmod(i, size)
+    mask = 0
+    for dr, dc in offsets:
+      nr, nc = r + dr, c + dc
+      # Neighbors on the board are added to the cell's mask, and a neighbor
+      # past the edge of the board marks the cell as an edge cell
+      if 0 <= nr < size and 0 <= nc < size:
+        mask |= 1 << (nr * size + nc)
+      else:
+        edge |= 1 << i
+    neighbors.append(mask)
+  return tuple(neighbors), edge
+
+
+def _build_rays(size, offsets):
+  """Build the cell indices passed through from each cell in each direction."""
+  rays = []
+  for dr, dc in offsets:
+    direction_rays = []
+    for i in range(size * size):
+      r, c = divmod(i, size)
+      ray = []
+      # Step from the cell until the edge of the board, not including the
+      # starting cell itself
+      r, c = r + dr, c + dc
+      while 0 <= r < size and 0 <= c < size:
+        ray.append(r * size + c)
+        r, c = r + dr, c + dc
+      direction_rays.append(tuple(ray))
+    rays.append(tuple(direction_rays))
+  return tuple(rays)
+
+
+def _build_lines(rays):
+  """Build bitmasks of each cell together with the first n cells of its ray."""
+  lines = []
+  for direction_rays in rays:
+    direction_lines = []
+    for start, ray in enumerate(direction_rays):
+      mask = 1 << start
+      masks = [mask]
+      for cell in ray:
+        mask |= 1 << cell
+        masks.append(mask)
+      direction_lines.append(tuple(masks))
+    lines.append(tuple(direction_lines))
+  return tuple(lines)
+
+
+if hasattr(int, 'bit_count'):
+  _popcount = int.bit_count
+else:  # pragma: no cover
+  def _popcount(bitboard):
+    """Count the set bits of a bitboard (int.bit_count before Python 3.10)."""
+    return bin(bitboard).count('1')
+
+
+def _make_push(rays, lines, step):
+  """Build a push function specialized to a single direction."""
+  # The returned function takes the white, black, and red bitboards and the
+  # index of the pushed cell, and returns the bitboards after the push and the
+  # bitmask of the cell whose marble was pushed off the board (0 if none was)
+  # Moving a bitboard by step cells is a shift left by `left` followed by a
+  # shift right by `right`, with one of the two always 0
+  left = max(step, 0)
+  right = max(-step, 0)
+
+  def push(white, black, red, start):
+    """Push the line of marbles at a cell one cell along the direction."""
+    occupied = white | black | red
+    ray = rays[start]
+
+    # Count the marbles in the direction until a absent marble, or the board
+    # end is reached
+    length = 0
+    for cell in ray:
+      if not occupied >> cell & 1:
+        break
+      length += 1
+    moving = lines[start][length]
+
+    pushed_off = 0
+    if length == len(ray):
+      # Every cell up to the edge is occupied, so the last marble is pushed
+      # off the board
+      pushed_off = 1 << (ray[-1] if ray else start)
+      moving &= ~pushed_off
+      white &= ~pushed_off
+      black &= ~pushed_off
+      red &= ~pushed_off
+
+    # Move each remaining marble one cell along the direction
+    return (
+        (white & ~moving) | (white & moving) << left >> right,
+        (black & ~moving) | (black & moving) << left >> right,
+        (red & ~moving) | (red & moving) << left >> right,
+        pushed_off,
+    )
+
+  return push
+
+
+def _build_pushes(size, offsets, rays, lines):
+  """Build a specialized push function for each direction."""
+  return tuple(
+      _make_push(direction_rays, direction_lines, dr * size + dc)
+      for (dr, dc), direction_rays, direction_lines
+      in zip(offsets, rays, lines)
+  )
+
+
 class KubaGame:
   """Representation of an instance of Kuba."""
 
   # Mapping of directions to (row, column) offsets
   DIRECTIONS = {
-      'F': (-1, 0),
-      'R': (0, 1),
-      'L': (0, -1),
-      'B': (1, 0),
+      direction: _DIR_OFFSETS[i]
+      for direction, i in _DIR_INDEX.items()
   }
 
+  # Number of rows and columns on the board
+  SIZE = 7
+
+  # Column numbers shown above and below the board when printed
+  COLUMN_HEADER = '   ' + ' '.join(str(i) for i in range(SIZE))
+
+  # Colors a player can play as, in color index order
+  PLAYER_COLORS = ('W', 'B')
+
+  # Starting layout of the board, one string per row
+  INITIAL_BOARD = (
+      'WWXXXBB',
+      'WWXRXBB',
+      'XXRRRXX',
+      'XRRRRRX',
+      'XXRRRXX',
+      'BBXRXWW',
+      'BBXXXWW',
+  )
+
+  # Bitmask of the on-board neighbors of each cell, and of the cells on the
+  # edge of the board, whose marbles can always be pushed off
+  NEIGHBORS, EDGE = _build_neighbor_tables(SIZE, _DIR_OFFSETS)
+
+  # Cell indices from each cell to the edge of the board, for each direction
+  # index
+  RAYS = _build_rays(SIZE, _DIR_OFFSETS)
+
+  # Bitmask of each cell and the first n cells of its ray, for each direction,
+  # so a pushed line never has to be built up one cell at a time
+  LINES = _build_lines(RAYS)
+
+  # Push function specialized to each direction index
+  PUSHES = _build_pushes(SIZE, _DIR_OFFSETS, RAYS, LINES)
+
   def __init__(self, player_one, player_two):
     """Create new instance of KubaGame with two player names and colors."""
     both_players = (player_one, player_two)
@@ -21,119 +176,119 @@ class KubaGame:
     for name, color in both_players:
       if not name:
         raise ValueError(f'Player name not valid: {name}')
-      if color not in 'WB':
+      if color not in self.PLAYER_COLORS:
         raise ValueError(f'Player color not valid: {color}')
 
     # Ensure player colors are unique
     if player_one[1] == player_two[1]:
       raise ValueError(f'Player colors must be unique {player_one[1]}')
 
-    # Create dictionaries for each player, remembering color and tracking
-    # captured neutral marbles
-    self._players_info = {
-        name: {'color': color, 'captured': 0}
+    # Map each player name to the index of their color, in the order the
+    # players were given
+    self._name_to_idx = {
+        name: self.PLAYER_COLORS.index(color)
         for name, color in both_players
     }
 
     # Ensure player names are unique
-    if len(self._players_info) != 2:
+    if len(self._name_to_idx) != 2:
       raise ValueError(f'Player names must be unique: {player_one[0]}')
 
-    # Initalize current, winner, board, and last board
-    self._current = None
+    # Player names and captured neutral marbles, indexed by color index
+    names = [None, None]
+    for name, idx in self._name_to_idx.items():
+      names[idx] = name
+    self._names = tuple(names)
+    self._captured = [0, 0]
+
+    # Color index of the first player, whose color is checked first if
+    # neither color has a legal move
+    self._first_idx = self._name_to_idx[player_one[0]]
+
+    # Initalize current color index (-1 before the first move) and winner
+    self._current_idx = -1
     self._winner = None
-    self._board = [
-        ['W', 'W', 'X', 'X', 'X', 'B', 'B'],
-        ['W', 'W', 'X', 'R', 'X', 'B', 'B'],
-        ['X', 'X', 'R', 'R', 'R', 'X', 'X'],
-        ['X', 'R', 'R', 'R', 'R', 'R', 'X'],
-        ['X', 'X', 'R', 'R', 'R', 'X', 'X'],
-        ['B', 'B', 'X', 'R', 'X', 'W', 'W'],
-        ['B', 'B', 'X', 'X', 'X', 'W', 'W']
+
+    # The board is stored as one bitboard per marble color, where the cell at
+    # (row, column) is bit row * SIZE + column
+    self._white = 0
+    self._black = 0
+    self._red = 0
+    for r, row in enumerate(self.INITIAL_BOARD):
+      for c, cell in enumerate(row):
+        self._set_marble((r, c), cell)
+
+    # Number of white, black, and red marbles on the board, kept up to date as
+    # marbles are pushed off
+    self._count = [
+        _popcount(self._white),
+        _popcount(self._black),
+        _popcount(self._red),
     ]
-    self._last_board = self._copy_board(self._board)
+
+    # Board before the last move, used to detect a move that undoes the
+    # previous one
+    self._last_board = self._white, self._black, self._red
 
   def get_marble_count(self):
     """Get the count of white, black, and red marbles."""
-    counts = [0, 0, 0]
-
-    for row in self._board:
-      for cell in row:
-        # Don't count absent cells
-        if cell == 'X':
-          continue
-
-        # Set index of cont based on marble color
-        if cell == 'W':
-          i = 0
-        elif cell == 'B':
-          i = 1
-        else:
-          i = 2
-        # Increment counter at index
-        counts[i] += 1
-
-    # Return counts as tuple
-    return tuple(counts)
+    return tuple(self._count)
 
   def get_captured(self, player_name):
     """Get the number of captured marbles for the provided player name."""
     # Return 0 if the player_name is not playing
-    if player_name not in self._players_info:
+    if player_name not in self._name_to_idx:
       return 0
 
-    return self._players_info[player_name]['captured']
+    return self._captured[self._name_to_idx[player_name]]
 
   def get_current_turn(self):
     """Get the name of the players who turn is currently is."""
-    return self._current
+    if self._current_idx < 0:
+      return None
+    return self._names[self._current_idx]
 
   def get_winner(self):
     """Get the name of the winning player."""
     return self._winner
 
-  @staticmethod
-  def _boards_equal(a, b):
-    """Return if both provides boards are equal."""
-    # Enumerate through all the rows and cells of the first, returning
-    # False if any of the cells do not equal the cell at the same position
-    # in the other board
-    for r, row in enumerate(a):
-      for c, cell in enumerate(row):
-        if cell != b[r][c]:
-          return False
-
-    # Otherwise, return True
-    return True
-
-  @staticmethod
-  def _copy_board(board):
-    """Make a copy of the provided board."""
-    # Initalized empty new board
-    copy = []
-    # Iterate over all the rows of the current board, appending copies to the
-    # copy board
-    for row in board:
-      copy.append(row.copy())
-    # Return the copy board
-    return copy
-
-  def _has_legal_move(self, marble):
-    """Return if the provided marble has a single leval move available."""
-    # Iterate through all the direction offsets
-    for offset in self.DIRECTIONS.values():
-      try:
-        # If the marble in the currection direction is absent, or off-board,
-        # return True
-        if self.get_marble((
-            marble[0] + offset[0],
-            marble[1] + offset[1]
-        )) == 'X':
-          return True
-      except IndexError:
-        return True
-    # Otherwise, return False
-    return False
+  def _board_string(self):
+    """Return the board as one character per cell, row by row."""
+    cells = bytearray(b'X' * (self.SIZE * self.SIZE))
+    # Fill in the character of each marble from its color's bitboard
+    for char, remaining in zip(b'WBR', (self._white, self._black, self._red)):
+      while remaining:
+        cell = (remaining & -remaining).bit_length() - 1
+        remaining &= remaining - 1
+        cells[cell] = char
+    return cells.decode()
+
+  def _set_marble(self, marble, color):
+    """Place a marble of the provided color (or 'X' for absent) on a cell."""
+    bit = 1 << (marble[0] * self.SIZE + marble[1])
+    # Clear the cell in every bitboard, then set it in the bitboard matching
+    # the new color
+    self._white &= ~bit
+    self._black &= ~bit
+    self._red &= ~bit
+    if color == 'W':
+      self._white |= bit
+    elif color == 'B':
+      self._black |= bit
+    elif color == 'R':
+      self._red |= bit
+
+  def _has_legal_move(self, cell, occupied):
+    """Return if the marble at the provided inner cell has a legal move."""
+    # A marble inside the edge of the board can be pushed if any of its
+    # neighbors are absent
+    return bool(self.NEIGHBORS[cell] & ~occupied)
+
+  @classmethod
+  def _in_bounds(cls, marble):
+    """Return if the provided marble position is on the board."""
+    r, c = marble
+    return 0 <= r < cls.SIZE and 0 <= c < cls.SIZE
 
   def make_move(self, player_name, marble, direction):
     """Have the player move the provided board in the provided direction."""
@@ -142,153 +297,137 @@ class KubaGame:
       return False
 
     # Invalid direction
-    if direction not in self.DIRECTIONS:
+    dir_idx = _DIR_INDEX.get(direction)
+    if dir_idx is None:
       return False
 
     # Invalid player name
-    if player_name not in self._players_info:
+    idx = self._name_to_idx.get(player_name)
+    if idx is None:
       return False
 
-    info = self._players_info[player_name]
-
-    current = self.get_current_turn()
+    current_idx = self._current_idx
     # Not the players turn
-    if current is not None and current != player_name:
+    if current_idx >= 0 and current_idx != idx:
       return False
 
     # Invalid marble position
-    try:
-      marble_color = self.get_marble(marble)
-    except IndexError:
+    if not self._in_bounds(marble):
       return False
 
     # Not moving own marble
-    if marble_color != info['color']:
+    white, black, red = self._white, self._black, self._red
+    size = self.SIZE
+    r, c = marble
+    start = r * size + c
+    if not (black if idx else white) >> start & 1:
       return False
 
-    offset = self.DIRECTIONS[direction]
-    behind = marble[0] + -offset[0], marble[1] + -offset[1]
-    try:
-      behind_color = self.get_marble(behind)
-      # Cell behind marble is not empty/off board
-      if behind_color != 'X':
-        return False
-    except IndexError:
-      pass
-
-    # Collect all marbles in the direction until a absent marble, or the board
-    # end is reached
-    moving_marbles = [marble]
-    while True:
-      last_marble = moving_marbles[-1]
-      current = last_marble[0] + offset[0], last_marble[1] + offset[1]
-      try:
-        current_color = self.get_marble(current)
-        if current_color == 'X':
-          break
-        moving_marbles.append(current)
-      except IndexError:
-        break
+    # Cell behind marble is not empty/off board
+    dr, dc = _DIR_OFFSETS[dir_idx]
+    occupied = white | black | red
+    behind = r - dr, c - dc
+    if self._in_bounds(behind) and occupied >> (start - dr * size - dc) & 1:
+      return False
 
-    board_backup = self._copy_board(self._board)
-
-    # Move each marble value to it's destination
-    for moving in moving_marbles[::-1]:
-      destination = moving[0] + offset[0], moving[1] + offset[1]
-      try:
-        self.get_marble(destination)
-        self._board[destination[0]][destination[1]] = self.get_marble(moving)
-        self._board[moving[0]][moving[1]] = 'X'
-      except IndexError:
-        # Increment the captured counter if the marble that got moved off the
-        # board was red
-        if self.get_marble(moving) == 'R':
-          info['captured'] += 1
+    new_white, new_black, new_red, pushed_off = self.PUSHES[dir_idx](
+        white,
+        black,
+        red,
+        start
+    )
 
     # Ensure the move did not just undo a previous move
-    if self._boards_equal(self._board, self._last_board):
-      self._board = board_backup
+    if (new_white, new_black, new_red) == self._last_board:
       return False
-    self._last_board = board_backup
+
+    # Decrement the count of the color of the marble pushed off, and
+    # increment the captured counter if it was red
+    if pushed_off:
+      if white & pushed_off:
+        self._count[0] -= 1
+      elif black & pushed_off:
+        self._count[1] -= 1
+      else:
+        self._count[2] -= 1
+        self._captured[idx] += 1
+
+    self._last_board = white, black, red
+    self._white, self._black, self._red = new_white, new_black, new_red
 
     # Set the winner to the current player if they've captured at least 7
     # neutral marbles, or of the number of opponent marbles is 0
-    if info['captured'] >= 7:
+    if self._captured[idx] >= 7:
       self._winner = player_name
-    elif self.get_marble_count()[info['color'] == 'W'] == 0:
+    elif self._count[1 - idx] == 0:
       self._winner = player_name
     else:
-      # Initalize boolean for both players, keeping track if they have any
-      # legal moves available
-      have_legal_moves = {
-          info['color']: False
-          for info in self._players_info.values()
-      }
-      for r, row in enumerate(self._board):
-        for c, cell in enumerate(row):
-          # Ignore absent cells
-          if cell not in have_legal_moves:
+      # Flag which colors have any legal moves available, bit 0 for white and
+      # bit 1 for black. A color with a marble on the edge always has one, so
+      # its marbles only need scanning when it has none left on the edge
+      edge = self.EDGE
+      flags = bool(new_white & edge) | bool(new_black & edge) << 1
+      if flags != 0b11:
+        occupied = new_white | new_black | new_red
+        for color_idx, remaining in enumerate((new_white, new_black)):
+          if flags >> color_idx & 1:
             continue
-          if self._has_legal_move((r, c)):
-            have_legal_moves[cell] = True
-            # Mark them as having legal moves, and if now both players
-            # have legal moves, break out of both loops
-            if all(have_legal_moves.values()):
+          # Visit each marble of the color, lowest bit first, stopping as soon
+          # as one of them has a legal move
+          while remaining:
+            cell = (remaining & -remaining).bit_length() - 1
+            remaining &= remaining - 1
+            if self._has_legal_move(cell, occupied):
+              flags |= 1 << color_idx
               break
-        if all(have_legal_moves.values()):
-          break
-      # Get player colorthat does not have any legal moves available
-      moveless_color = next(
-          (
-              color
-              for color, has_legal_moves in have_legal_moves.items()
-              if not has_legal_moves
-          ),
-          None
-      )
-      # If there is a color that has no legal moves, set the winner to the
-      # opposite player
-      if moveless_color:
-        self._winner = next(
-            name
-            for name, info in self._players_info.items()
-            if info['color'] != moveless_color
-        )
+      if flags != 0b11:
+        # Get player color index that does not have any legal moves available,
+        # and set the winner to the opposite player
+        moveless_idx = self._first_idx
+        if flags >> moveless_idx & 1:
+          moveless_idx = 1 - moveless_idx
+        self._winner = self._names[1 - moveless_idx]
 
     # Set the current user to the opposite of the current user
-    self._current = next(
-        name
-        for name in self._players_info.keys()
-        if name != player_name
-    )
+    self._current_idx = 1 - idx
 
     return True
 
   def get_marble(self, marble):
     """Return the color of the provided marble."""
-    # If either of the coordinates are negative, raise an IndexError,
+    # If either of the coordinates are outside the board, raise an IndexError,
     # indicating being off the board
-    if marble[0] < 0 or marble[1] < 0:
+    if not self._in_bounds(marble):
       raise IndexError()
-    return self._board[marble[0]][marble[1]]
+    bit = 1 << (marble[0] * self.SIZE + marble[1])
+    if self._white & bit:
+      return 'W'
+    if self._black & bit:
+      return 'B'
+    if self._red & bit:
+      return 'R'
+    return 'X'
 
   def __str__(self) -> str:  # pragma: no cover
     """Return the string representation of the game state, including board."""
     white, black, red = self.get_marble_count()
-    players = list(self._players_info.items())
+    players = list(self._name_to_idx)
     lines: List[str] = [
         f'Current Turn: {self.get_current_turn()}',
         f'Counts      : W={white} B={black} R={red}',
-        f'Captured    : {players[0][0]}={players[0][1]["captured"]} '
-        f'{players[1][0]}={players[1][1]["captured"]}',
+        f'Captured    : {players[0]}={self.get_captured(players[0])} '
+        f'{players[1]}={self.get_captured(players[1])}',
         '',
-        '   ' + ' '.join([str(i) for i in range(7)]),
+        self.COLUMN_HEADER,
         ''
     ]
-    for r, row in enumerate(self._board):
-      lines.append(str(r) + '  ' + ' '.join(row) + '  ' + str(r))
+    size = self.SIZE
+    board = self._board_string()
+    for r in range(size):
+      row = ' '.join(board[r * size:(r + 1) * size])
+      lines.append(f'{r}  {row}  {r}')
     lines.append('')
-    lines.append('   ' + ' '.join([str(i) for i in range(7)]))
+    lines.append(self.COLUMN_HEADER)
     return '\n'.join(lines)
 
 
@@ -337,6 +476,14 @@ def main():
   assert game.make_move('PlayerA', (6, 5), 'L') is False
   assert game.get_marble((5, 5)) == 'W'
 
+  # A lone marble pushed off the edge is removed from the board
+  game = KubaGame(('A', 'W'), ('Bo', 'B'))
+  assert game.make_move('A', (0, 0), 'R') is True
+  assert game.make_move('Bo', (0, 5), 'R') is True
+  assert game.make_move('A', (0, 2), 'F') is True
+  assert game.get_marble((0, 2)) == 'X'
+  assert game.get_marble_count() == (7, 7, 13)
+
 
 if __name__ == '__main__':
   main()